@@ -1,16 +1,27 @@
 import streamlit as st
 import os
-import json
+import math
+import atexit
 import base64
 import io
+import copy
+import hashlib
+import itertools
+import multiprocessing
+import random
+import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from typing import List, Optional, Dict, Any
-from google import genai
-from google.genai import types
-from PIL import Image
-from fpdf import FPDF
+import numpy as np
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
+from pdf_generator import format_eur, generate_pdf_bytes
 
 # Cargar variables de entorno
 load_dotenv()
@@ -28,9 +39,44 @@ st.set_page_config(
 FILES_DIR = "data"
 SETTINGS_FILE = os.path.join(FILES_DIR, "settings.json")
 CLIENTS_FILE = os.path.join(FILES_DIR, "clients.json")
+GEMINI_CACHE_DIR = os.path.join(FILES_DIR, "gemini_cache")
 
-# Asegurar que existe el directorio
+# Subir al cambiar el prompt o el schema de Gemini: invalida la caché de extracciones
+PROMPT_VERSION = 2
+
+# Vida de una extracción cacheada, en memoria y en disco (data/gemini_cache)
+EXTRACTION_CACHE_TTL_SECONDS = 3600
+# Cada cuánto se limpian como mucho las extracciones caducadas del disco
+EXTRACTION_CACHE_PRUNE_INTERVAL_SECONDS = 600
+
+# Tamaño máximo (px) del logo guardado: en el PDF se dibuja a 30 mm de ancho
+LOGO_MAX_SIZE = (300, 300)
+
+# Los guardados seguidos de clientes/ajustes se agrupan en una escritura en disco
+SAVE_DEBOUNCE_SECONDS = 0.5
+
+# Nº máximo de peticiones simultáneas a Gemini al procesar un lote (los 429 por
+# exceso de cuota se reintentan esperando lo que indique el servidor)
+MAX_CONCURRENT_REQUESTS = 8
+
+# Por encima de este tamaño, los albaranes se suben por la Files API de Gemini
+INLINE_DATA_MAX_BYTES = 2_000_000
+
+# Albaranes (pequeños) que se agrupan como máximo en una misma petición a Gemini
+BATCH_REQUEST_SIZE = 5
+
+# Reintentos ante límite de cuota (429) o fallos transitorios del servidor
+RETRYABLE_STATUS_CODES = {429, 500, 503}
+MAX_RETRIES = 4
+# Tope de espera por reintento aunque el servidor pida más (ventana de cuota por minuto)
+MAX_RETRY_DELAY_SECONDS = 60
+
+# Nº de procesos para generar los PDF del ZIP en paralelo
+PDF_WORKERS = min(4, os.cpu_count() or 1)
+
+# Asegurar que existen los directorios
 os.makedirs(FILES_DIR, exist_ok=True)
+os.makedirs(GEMINI_CACHE_DIR, exist_ok=True)
 
 DEFAULT_SETTINGS = {
     "name": "",
@@ -43,21 +89,130 @@ DEFAULT_SETTINGS = {
 def load_json(filepath, default):
     if os.path.exists(filepath):
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
+            with open(filepath, 'rb') as f:
+                return orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
             return default
     return default
 
+@st.cache_resource
+def get_default_file_mode():
+    # Permisos que daría open(..., 'w'): 0666 menos la umask. La umask solo se
+    # puede leer cambiándola, así que se hace una vez por proceso.
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+FILE_MODE = get_default_file_mode()
+
+def write_file_atomic(filepath, content):
+    # Escribir en un temporal del mismo directorio y renombrar: un fallo a
+    # mitad de escritura nunca deja el fichero original corrupto
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        # mkstemp crea el temporal con 0600 y os.replace conservaría ese modo
+        os.chmod(tmp_path, FILE_MODE)
+        os.replace(tmp_path, filepath)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+def flush_pending_saves(queue):
+    # write_lock serializa los flush: uno lento no se solapa con el siguiente,
+    # así una versión antigua nunca sobrescribe a otra más nueva
+    with queue['write_lock']:
+        with queue['lock']:
+            pending, queue['pending'], queue['timer'] = queue['pending'], {}, None
+        for filepath, (content, owners) in pending.items():
+            try:
+                write_file_atomic(filepath, content)
+            except OSError as e:
+                # Hilo del Timer: no puede usar st.*, el error se deja en la lista
+                # de cada sesión que guardó esta ruta y se muestra en su siguiente
+                # run. 'written' no cambia, así que se puede reintentar.
+                for errors in owners:
+                    errors.append(f"No se pudo guardar {filepath}: {e}")
+                continue
+            with queue['lock']:
+                queue['written'][filepath] = content
+
+@st.cache_resource
+def get_save_queue():
+    # Cola de escrituras compartida por el proceso (sobrevive a los reruns).
+    # 'written' guarda lo último escrito en cada ruta: settings.json y
+    # clients.json son comunes a todas las sesiones, así que se compara con eso.
+    # 'pending' guarda, por ruta, el contenido y las listas de errores de las
+    # sesiones que lo han guardado.
+    queue = {"pending": {}, "written": {}, "timer": None, "lock": threading.Lock(), "write_lock": threading.Lock()}
+    atexit.register(flush_pending_saves, queue)
+    return queue
+
+def pop_save_errors():
+    # Errores de los guardados de esta sesión; la lista es la misma que tiene la
+    # cola, así que se vacía en sitio (el Timer puede estar añadiendo otro)
+    errors = st.session_state.setdefault('_save_errors', [])
+    popped = errors[:]
+    del errors[:len(popped)]
+    return popped
+
 def save_json(filepath, data):
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    content = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    session_errors = st.session_state.setdefault('_save_errors', [])
+    # Escritura en segundo plano con debounce: solo se escribe la última versión
+    queue = get_save_queue()
+    with queue['lock']:
+        pending_content, owners = queue['pending'].get(filepath, (None, []))
+        if not any(errors is session_errors for errors in owners):
+            owners = owners + [session_errors]
+        if pending_content == content:
+            queue['pending'][filepath] = (content, owners)
+            return
+        # No reescribir el fichero si ya tiene este contenido
+        if pending_content is None and queue['written'].get(filepath) == content:
+            return
+        queue['pending'][filepath] = (content, owners)
+        if queue['timer']:
+            queue['timer'].cancel()
+        queue['timer'] = threading.Timer(SAVE_DEBOUNCE_SECONDS, flush_pending_saves, args=(queue,))
+        queue['timer'].daemon = True
+        queue['timer'].start()
+
+def compute_line_totals(items):
+    # Cantidad x precio vectorizado; las celdas vacías del editor llegan como
+    # None o NaN (que es truthy y se cuela por el `or 0`): ambas cuentan como 0
+    qty = np.fromiter((item.get('quantity') or 0 for item in items), dtype=np.float64, count=len(items))
+    price = np.fromiter((item.get('unitPrice') or 0 for item in items), dtype=np.float64, count=len(items))
+    qty = np.nan_to_num(qty, nan=0.0, posinf=0.0, neginf=0.0)
+    price = np.nan_to_num(price, nan=0.0, posinf=0.0, neginf=0.0)
+    for item, total in zip(items, (qty * price).tolist()):
+        item['total'] = total
+
+def compute_totals(items, tax_rate):
+    # Aritmética en céntimos enteros para no arrastrar errores de coma flotante.
+    # Las celdas vacías del data_editor llegan como NaN (o None): cuentan como 0
+    line_totals = np.fromiter((item.get('total') or 0 for item in items), dtype=np.float64, count=len(items))
+    line_totals = np.nan_to_num(line_totals, nan=0.0, posinf=0.0, neginf=0.0)
+    # Céntimos por línea "half up" (np.rint redondearía 0,5 al par); el round a 6
+    # decimales absorbe el error binario de productos como 1.005 * 100 = 100.4999...
+    subtotal_cents = int(np.floor(np.round(line_totals * 100, 6) + 0.5).sum())
+    # IVA redondeado al céntimo "half up" (0,525 -> 0,53), como se factura en
+    # España: el % en centésimas enteras evita el round() bancario de Python
+    rate_bp = round(tax_rate * 100)
+    tax_cents = (subtotal_cents * rate_bp + 5000) // 10000
+    return {
+        "subtotal": subtotal_cents / 100,
+        "taxAmount": tax_cents / 100,
+        "total": (subtotal_cents + tax_cents) / 100
+    }
 
 # Cargar estado inicial
 if 'settings' not in st.session_state:
     st.session_state.settings = load_json(SETTINGS_FILE, DEFAULT_SETTINGS)
-if 'clients' not in st.session_state:
-    st.session_state.clients = load_json(CLIENTS_FILE, [])
+if 'clients_by_name' not in st.session_state:
+    # En disco es una lista; en memoria, un dict por nombre para altas/cambios O(1)
+    st.session_state.clients_by_name = {c['name']: c for c in load_json(CLIENTS_FILE, [])}
 if 'processed_invoices' not in st.session_state:
     st.session_state.processed_invoices = []
 if 'current_invoice_index' not in st.session_state:
@@ -65,19 +220,9 @@ if 'current_invoice_index' not in st.session_state:
 
 # --- 2. SERVICIOS (GEMINI & PDF) ---
 
-def get_gemini_client():
-    api_key = os.environ.get("API_KEY")
-    if not api_key:
-        st.error("⚠️ No se ha encontrado la API Key. Configura la variable de entorno API_KEY.")
-        return None
-    return genai.Client(api_key=api_key)
-
-def process_invoice_with_gemini(file_bytes, mime_type, filename):
-    client = get_gemini_client()
-    if not client:
-        return None
+GEMINI_MODEL = 'gemini-2.5-flash'
 
-    prompt = """
+EXTRACTION_PROMPT = """
       Actúa como un sistema experto en digitalización de documentos administrativos.
       Analiza el archivo adjunto (albarán/nota de entrega).
       
@@ -101,214 +246,371 @@ def process_invoice_with_gemini(file_bytes, mime_type, filename):
       - notes: Observaciones.
 
       Devuelve SOLO JSON válido.
-    """
+"""
+
+BATCH_PROMPT = """
+      Se adjuntan {n} albaranes, cada uno precedido de la etiqueta "Documento N".
+      Aplica las instrucciones a cada uno por separado y devuelve un objeto
+      {{"invoices": [...]}} con un elemento por archivo. En cada elemento, el campo
+      documentIndex es el número N de la etiqueta de su documento.
+"""
+
+# Los SDK pesados (google.genai, PIL) se importan dentro de las funciones que
+# los usan: quien solo edita o navega no paga su importación en el arranque.
+
+@st.cache_resource(show_spinner=False)
+def create_gemini_client(api_key):
+    # Un único cliente (y su pool HTTP) por API key, reutilizado entre reruns
+    from google import genai
+    return genai.Client(api_key=api_key)
 
+def get_gemini_client():
+    api_key = os.environ.get("API_KEY")
+    if not api_key:
+        st.error("⚠️ No se ha encontrado la API Key. Configura la variable de entorno API_KEY.")
+        return None
+    return create_gemini_client(api_key)
+
+def prune_extraction_cache_dir():
+    # Borrar del disco las extracciones caducadas o de otra versión del prompt
+    # (los .tmp recientes son escrituras atómicas en curso y se respetan)
+    now = time.time()
+    suffix = f"-v{PROMPT_VERSION}.json"
+    for entry in os.scandir(GEMINI_CACHE_DIR):
+        try:
+            old_version = entry.name.endswith('.json') and not entry.name.endswith(suffix)
+            if old_version or now - entry.stat().st_mtime > EXTRACTION_CACHE_TTL_SECONDS:
+                os.remove(entry.path)
+        except OSError:
+            pass # Otro proceso ya lo ha borrado
+
+@st.cache_resource
+def get_extraction_cache():
+    # Caché en memoria compartida entre sesiones; TTLCache no es thread-safe.
+    # Se crea una vez por proceso: buen momento para limpiar el directorio.
+    prune_extraction_cache_dir()
+    return TTLCache(maxsize=512, ttl=EXTRACTION_CACHE_TTL_SECONDS), threading.Lock()
+
+@st.cache_resource
+def get_prune_state():
+    # get_extraction_cache ya limpia al arrancar el proceso
+    return {"last": time.time(), "lock": threading.Lock()}
+
+def maybe_prune_extraction_cache_dir():
+    # En un servidor de larga duración, limpiar también de vez en cuando
+    state = get_prune_state()
+    now = time.time()
+    with state['lock']:
+        if now - state['last'] < EXTRACTION_CACHE_PRUNE_INTERVAL_SECONDS:
+            return
+        state['last'] = now
+    prune_extraction_cache_dir()
+
+def extraction_cache_key(file_bytes):
+    return f"{hashlib.blake2b(file_bytes, digest_size=16).hexdigest()}-v{PROMPT_VERSION}"
+
+def get_cached_extraction(key):
+    cache, lock = get_extraction_cache()
+    with lock:
+        data = cache.get(key)
+    if data is None:
+        # Rehidratar desde disco para que la caché sobreviva a reinicios, salvo
+        # que la entrada haya caducado (misma vida que en memoria)
+        path = os.path.join(GEMINI_CACHE_DIR, f"{key}.json")
+        try:
+            expired = time.time() - os.path.getmtime(path) > EXTRACTION_CACHE_TTL_SECONDS
+        except OSError:
+            return None
+        if expired:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        data = load_json(path, None)
+        if data is not None:
+            with lock:
+                cache[key] = data
+    return data
+
+def store_cached_extraction(key, data):
+    data = {k: v for k, v in data.items() if k != 'filename'}
+    cache, lock = get_extraction_cache()
+    with lock:
+        cache[key] = data
     try:
-        # Codificar imagen/pdf para Gemini
-        b64_data = base64.b64encode(file_bytes).decode('utf-8')
-        
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[
-                types.Content(
-                    parts=[
-                        types.Part.from_bytes(data=file_bytes, mime_type=mime_type),
-                        types.Part.from_text(text=prompt)
-                    ]
-                )
-            ],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                response_schema=types.Schema(
+        write_file_atomic(os.path.join(GEMINI_CACHE_DIR, f"{key}.json"), orjson.dumps(data))
+    except OSError:
+        pass # La copia en disco es solo una optimización: queda la de memoria
+    maybe_prune_extraction_cache_dir()
+
+def get_server_retry_delay(error):
+    # Espera pedida por el servidor: RetryInfo.retryDelay en el cuerpo del error
+    # (p.ej. "37s") o, si no, la cabecera Retry-After. None si no indica nada.
+    details = error.details if isinstance(error.details, dict) else {}
+    details = details.get('error', details)
+    for detail in details.get('details', []) if isinstance(details, dict) else []:
+        if isinstance(detail, dict) and detail.get('@type', '').endswith('google.rpc.RetryInfo'):
+            try:
+                return float(str(detail.get('retryDelay', '')).rstrip('s'))
+            except ValueError:
+                pass
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers:
+        try:
+            return float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def generate_with_backoff(client, **kwargs):
+    from google.genai import errors as genai_errors
+
+    # Espera exponencial con jitter para no reintentar todos los hilos a la vez;
+    # si el servidor indica cuánto esperar (cuota por minuto), se respeta
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return client.models.generate_content(**kwargs)
+        except genai_errors.APIError as e:
+            if e.code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRIES:
+                raise
+            delay = max(get_server_retry_delay(e) or 0, 0.25 * 2 ** attempt)
+            time.sleep(min(delay, MAX_RETRY_DELAY_SECONDS) + random.uniform(0, 0.25))
+
+@st.cache_resource(show_spinner=False)
+def get_extraction_request():
+    # Schema, config y Part del prompt son constantes: se construyen una vez por
+    # proceso en lugar de en cada archivo. El prompt va en línea: no llega al
+    # mínimo de tokens de la caché de contexto explícita de Gemini.
+    from google.genai import types
+
+    response_schema = types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            "invoiceNumber": types.Schema(type=types.Type.STRING),
+            "date": types.Schema(type=types.Type.STRING),
+            "dueDate": types.Schema(type=types.Type.STRING),
+            "supplierName": types.Schema(type=types.Type.STRING),
+            "supplierAddress": types.Schema(type=types.Type.STRING),
+            "clientName": types.Schema(type=types.Type.STRING),
+            "clientCif": types.Schema(type=types.Type.STRING),
+            "clientAddress": types.Schema(type=types.Type.STRING),
+            "items": types.Schema(
+                type=types.Type.ARRAY,
+                items=types.Schema(
                     type=types.Type.OBJECT,
                     properties={
-                        "invoiceNumber": types.Schema(type=types.Type.STRING),
-                        "date": types.Schema(type=types.Type.STRING),
-                        "dueDate": types.Schema(type=types.Type.STRING),
-                        "supplierName": types.Schema(type=types.Type.STRING),
-                        "supplierAddress": types.Schema(type=types.Type.STRING),
-                        "clientName": types.Schema(type=types.Type.STRING),
-                        "clientCif": types.Schema(type=types.Type.STRING),
-                        "clientAddress": types.Schema(type=types.Type.STRING),
-                        "items": types.Schema(
-                            type=types.Type.ARRAY,
-                            items=types.Schema(
-                                type=types.Type.OBJECT,
-                                properties={
-                                    "description": types.Schema(type=types.Type.STRING),
-                                    "quantity": types.Schema(type=types.Type.NUMBER),
-                                    "unitPrice": types.Schema(type=types.Type.NUMBER),
-                                    "total": types.Schema(type=types.Type.NUMBER),
-                                }
-                            )
-                        ),
-                        "subtotal": types.Schema(type=types.Type.NUMBER),
-                        "taxRate": types.Schema(type=types.Type.NUMBER),
-                        "taxAmount": types.Schema(type=types.Type.NUMBER),
+                        "description": types.Schema(type=types.Type.STRING),
+                        "quantity": types.Schema(type=types.Type.NUMBER),
+                        "unitPrice": types.Schema(type=types.Type.NUMBER),
                         "total": types.Schema(type=types.Type.NUMBER),
-                        "notes": types.Schema(type=types.Type.STRING),
                     }
                 )
+            ),
+            "subtotal": types.Schema(type=types.Type.NUMBER),
+            "taxRate": types.Schema(type=types.Type.NUMBER),
+            "taxAmount": types.Schema(type=types.Type.NUMBER),
+            "total": types.Schema(type=types.Type.NUMBER),
+            "notes": types.Schema(type=types.Type.STRING),
+        }
+    )
+    config = types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=response_schema
+    )
+    # Varios albaranes por petición: {invoices: [factura, ...]}, cada factura con
+    # el índice de su documento para no depender del orden de la respuesta
+    batch_invoice_schema = types.Schema(
+        type=types.Type.OBJECT,
+        properties={**response_schema.properties, "documentIndex": types.Schema(type=types.Type.INTEGER)},
+        required=["documentIndex"]
+    )
+    batch_config = types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=types.Schema(
+            type=types.Type.OBJECT,
+            properties={
+                "invoices": types.Schema(type=types.Type.ARRAY, items=batch_invoice_schema),
+            },
+            required=["invoices"]
+        )
+    )
+    prompt_parts = (types.Part.from_text(text=EXTRACTION_PROMPT),)
+    return config, batch_config, prompt_parts
+
+def delete_uploaded_file(client, name):
+    try:
+        client.files.delete(name=name)
+    except Exception:
+        pass # Gemini los elimina igualmente a las 48 h
+
+def process_invoice_with_gemini(client, file_bytes, mime_type, filename, config, prompt_parts):
+    # Se ejecuta en hilos del pool: no se llama a st.* aquí, se devuelve
+    # (datos, error) y el hilo principal muestra el error.
+    from google.genai import types
+
+    uploaded = None
+    try:
+        if len(file_bytes) > INLINE_DATA_MAX_BYTES:
+            # Archivos grandes: subida por la Files API, la petición solo lleva la URI
+            uploaded = client.files.upload(
+                file=io.BytesIO(file_bytes),
+                config=types.UploadFileConfig(mime_type=mime_type)
             )
+            parts = [types.Part.from_uri(file_uri=uploaded.uri, mime_type=mime_type)]
+        else:
+            # Los bytes se envían tal cual (Part.from_bytes), sin copia base64 intermedia
+            parts = [types.Part.from_bytes(data=file_bytes, mime_type=mime_type)]
+        parts.extend(prompt_parts)
+
+        response = generate_with_backoff(
+            client,
+            model=GEMINI_MODEL,
+            contents=[types.Content(parts=parts)],
+            config=config
         )
         
-        data = json.loads(response.text)
+        data = orjson.loads(response.text)
         data['filename'] = filename # Guardar referencia al archivo original
-        return data
+        return data, None
 
     except Exception as e:
-        st.error(f"Error procesando {filename}: {str(e)}")
-        return None
+        return None, f"Error procesando {filename}: {str(e)}"
+
+    finally:
+        if uploaded:
+            # Borrar el archivo subido en segundo plano para no agotar la cuota
+            threading.Thread(target=delete_uploaded_file, args=(client, uploaded.name), daemon=True).start()
+
+@st.cache_data(max_entries=64, ttl=600, show_spinner=False)
+def _render_invoice_pdf(invoice_data, settings, logo_mtime):
+    # st.download_button y st.pdf exigen bytes; se convierte una vez por PDF cacheado
+    return bytes(generate_pdf_bytes(invoice_data, settings))
+
+def get_logo_mtime(settings):
+    # El logo se sobrescribe siempre en la misma ruta: su fecha sirve de versión
+    logo_path = settings.get('logo_path')
+    return os.path.getmtime(logo_path) if logo_path and os.path.exists(logo_path) else None
+
+def render_invoice_pdf(invoice_data, settings):
+    # PDF memoizado por (factura, ajustes): los reruns sin cambios no re-renderizan.
+    # 'filename' no afecta al PDF y se quita; la fecha del logo invalida la caché
+    # si se sube uno nuevo con la misma ruta.
+    invoice_data = {k: v for k, v in invoice_data.items() if k != 'filename'}
+    return _render_invoice_pdf(invoice_data, settings, get_logo_mtime(settings))
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def pdf_iframe_html(pdf_bytes):
+    # Mostrar PDF (truco para mostrar PDF embebido en Streamlit)
+    base64_pdf = base64.b64encode(pdf_bytes).decode('utf-8')
+    return f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="500" type="application/pdf"></iframe>'
+
+def show_pdf_preview(pdf_bytes):
+    # Visor nativo (Streamlit >= 1.49 con streamlit[pdf]): el PDF se sirve como
+    # archivo y no se incrusta en el DOM inflado un 33 % en base64
+    if hasattr(st, "pdf"):
+        try:
+            st.pdf(pdf_bytes, height=500)
+            return
+        except Exception:
+            pass # Falta el componente streamlit-pdf: usar el iframe
+    st.markdown(pdf_iframe_html(pdf_bytes), unsafe_allow_html=True)
+
+def process_invoice_batch_with_gemini(client, batch_jobs, config, batch_config, prompt_parts):
+    # Varios albaranes en una sola petición, correlacionados por documentIndex. Si
+    # la respuesta no se puede interpretar o no trae exactamente una factura por
+    # documento, se procesan uno a uno para que un documento problemático no
+    # arruine el resto del grupo.
+    from google.genai import types
+    from google.genai import errors as genai_errors
+
+    if len(batch_jobs) > 1:
+        parts = []
+        for i, (file_bytes, mime_type, _) in enumerate(batch_jobs):
+            parts.append(types.Part.from_text(text=f"Documento {i}"))
+            parts.append(types.Part.from_bytes(data=file_bytes, mime_type=mime_type))
+        parts.extend(prompt_parts)
+        parts.append(types.Part.from_text(text=BATCH_PROMPT.format(n=len(batch_jobs))))
 
-def generate_pdf_bytes(invoice_data, settings):
-    pdf = FPDF()
-    pdf.add_page()
-    
-    # Colores
-    primary_r, primary_g, primary_b = 37, 99, 235 # Blue-600
-    
-    # 1. Header & Logo
-    header_y = 20
-    
-    # Logo
-    if settings.get('logo_path') and os.path.exists(settings['logo_path']):
         try:
-            pdf.image(settings['logo_path'], x=10, y=10, w=30)
-            header_y = 45
-        except:
-            pass
+            response = generate_with_backoff(
+                client,
+                model=GEMINI_MODEL,
+                contents=[types.Content(parts=parts)],
+                config=batch_config
+            )
+        except genai_errors.APIError as e:
+            if e.code in RETRYABLE_STATUS_CODES:
+                # Cuota o servidor agotados tras los reintentos: repartir el grupo
+                # en N peticiones solo multiplicaría la carga
+                return [(None, f"Error procesando {filename}: {str(e)}") for _, _, filename in batch_jobs]
+            response = None # p.ej. 400 por un documento concreto: probar uno a uno
+        except Exception as e:
+            return [(None, f"Error procesando {filename}: {str(e)}") for _, _, filename in batch_jobs]
 
-    # Proveedor (Arriba Izquierda o debajo de logo)
-    pdf.set_font("Helvetica", "B", 14)
-    pdf.set_text_color(40, 40, 40)
-    pdf.set_xy(10 if not settings.get('logo_path') else 45, 15 if settings.get('logo_path') else 15)
-    
-    supplier_name = invoice_data.get('supplierName') or "PROVEEDOR"
-    pdf.cell(0, 10, supplier_name, new_x="LMARGIN", new_y="NEXT")
-    
-    pdf.set_font("Helvetica", "", 9)
-    pdf.set_text_color(100, 100, 100)
-    # Ajustar posición para dirección
-    pdf.set_xy(10 if not settings.get('logo_path') else 45, 22 if settings.get('logo_path') else 22)
-    pdf.multi_cell(80, 5, invoice_data.get('supplierAddress') or "")
-
-    # Título FACTURA (Arriba Derecha)
-    pdf.set_xy(150, 15)
-    pdf.set_font("Helvetica", "B", 20)
-    pdf.set_text_color(primary_r, primary_g, primary_b)
-    pdf.cell(50, 10, "FACTURA", align='R')
-    
-    # Metadatos (Debajo de título)
-    pdf.set_xy(140, 25)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.set_text_color(100, 100, 100)
-    pdf.cell(30, 5, "Nº Factura:", align='R')
-    pdf.set_font("Helvetica", "", 9)
-    pdf.set_text_color(0, 0, 0)
-    pdf.cell(30, 5, str(invoice_data.get('invoiceNumber', '---')), align='R', new_x="LMARGIN", new_y="NEXT")
-    
-    pdf.set_xy(140, 30)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.set_text_color(100, 100, 100)
-    pdf.cell(30, 5, "Fecha:", align='R')
-    pdf.set_font("Helvetica", "", 9)
-    pdf.set_text_color(0, 0, 0)
-    pdf.cell(30, 5, str(invoice_data.get('date', '')), align='R')
-
-    # 2. Cliente
-    start_y_client = max(pdf.get_y(), header_y) + 15
-    
-    pdf.set_xy(10, start_y_client)
-    pdf.set_fill_color(241, 245, 249)
-    pdf.rect(10, start_y_client, 190, 8, 'F')
-    
-    pdf.set_xy(12, start_y_client + 1.5)
-    pdf.set_font("Helvetica", "B", 10)
-    pdf.set_text_color(primary_r, primary_g, primary_b)
-    pdf.cell(0, 5, "FACTURAR A:")
-    
-    pdf.set_xy(10, start_y_client + 12)
-    pdf.set_font("Helvetica", "B", 10)
-    pdf.set_text_color(0, 0, 0)
-    pdf.cell(0, 5, invoice_data.get('clientName') or "CLIENTE", new_x="LMARGIN", new_y="NEXT")
-    
-    pdf.set_font("Helvetica", "", 9)
-    pdf.set_text_color(100, 100, 100)
-    if invoice_data.get('clientCif'):
-        pdf.cell(0, 5, f"CIF/NIF: {invoice_data.get('clientCif')}", new_x="LMARGIN", new_y="NEXT")
-    pdf.multi_cell(0, 5, invoice_data.get('clientAddress') or "")
-
-    # 3. Tabla
-    pdf.set_y(pdf.get_y() + 10)
-    
-    # Cabecera Tabla
-    pdf.set_fill_color(primary_r, primary_g, primary_b)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.cell(95, 8, "Descripción", fill=True)
-    pdf.cell(20, 8, "Cant.", align='R', fill=True)
-    pdf.cell(35, 8, "Precio U.", align='R', fill=True)
-    pdf.cell(40, 8, "Total", align='R', fill=True, new_x="LMARGIN", new_y="NEXT")
-    
-    # Items
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Helvetica", "", 9)
-    fill = False
-    for item in invoice_data.get('items', []):
-        pdf.cell(95, 8, str(item.get('description', '')), border='B')
-        pdf.cell(20, 8, str(item.get('quantity', 0)), align='R', border='B')
-        pdf.cell(35, 8, f"{item.get('unitPrice', 0):.2f} €", align='R', border='B')
-        pdf.cell(40, 8, f"{item.get('total', 0):.2f} €", align='R', border='B', new_x="LMARGIN", new_y="NEXT")
-
-    # 4. Totales
-    pdf.set_y(pdf.get_y() + 5)
-    x_totals = 130
-    
-    pdf.set_x(x_totals)
-    pdf.set_text_color(100, 100, 100)
-    pdf.cell(30, 6, "Subtotal:", align='R')
-    pdf.set_text_color(0, 0, 0)
-    pdf.cell(30, 6, f"{invoice_data.get('subtotal', 0):.2f} €", align='R', new_x="LMARGIN", new_y="NEXT")
-    
-    pdf.set_x(x_totals)
-    pdf.set_text_color(100, 100, 100)
-    tax_rate = invoice_data.get('taxRate', 21)
-    pdf.cell(30, 6, f"IVA ({tax_rate}%):", align='R')
-    pdf.set_text_color(0, 0, 0)
-    pdf.cell(30, 6, f"{invoice_data.get('taxAmount', 0):.2f} €", align='R', new_x="LMARGIN", new_y="NEXT")
-    
-    pdf.set_x(x_totals)
-    pdf.set_font("Helvetica", "B", 11)
-    pdf.set_text_color(primary_r, primary_g, primary_b)
-    pdf.cell(30, 10, "TOTAL:", align='R')
-    pdf.cell(30, 10, f"{invoice_data.get('total', 0):.2f} €", align='R')
-
-    # 5. Notas
-    if invoice_data.get('notes'):
-        pdf.set_y(pdf.get_y() + 15)
-        pdf.set_font("Helvetica", "B", 8)
-        pdf.set_text_color(150, 150, 150)
-        pdf.cell(0, 5, "NOTAS:", new_x="LMARGIN", new_y="NEXT")
-        pdf.set_font("Helvetica", "", 8)
-        pdf.multi_cell(0, 5, invoice_data.get('notes'))
-
-    return bytes(pdf.output())
+        try:
+            by_index = {}
+            for data in orjson.loads(response.text)['invoices'] if response else ():
+                by_index.setdefault(data.pop('documentIndex'), []).append(data)
+            if sorted(by_index) == list(range(len(batch_jobs))) and all(len(found) == 1 for found in by_index.values()):
+                return [({**by_index[i][0], 'filename': filename}, None) for i, (_, _, filename) in enumerate(batch_jobs)]
+        except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError):
+            pass # Respuesta mal formada: se procesa uno a uno
+    return [process_invoice_with_gemini(client, *job, config, prompt_parts) for job in batch_jobs]
+
+@st.cache_resource
+def get_pdf_executor():
+    # Pool de procesos persistente entre reruns: fpdf2 es Python puro y está
+    # limitado por el GIL. No se usa "fork": el servidor de Streamlit tiene
+    # varios hilos y un hijo clonado a mitad de un lock puede bloquearse. Con
+    # forkserver/spawn los hijos solo importan pdf_generator (sin Streamlit);
+    # app.py no se re-ejecuta porque el __main__ es la CLI de streamlit.
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context(method))
+
+def generate_all_pdfs(invoices, settings):
+    # Generador: entrega cada PDF en orden en cuanto está listo, para ir
+    # escribiendo el ZIP mientras los procesos renderizan los siguientes
+    executor = get_pdf_executor() if len(invoices) > 1 else None
+    done = 0
+    if executor is not None:
+        try:
+            for pdf_data in executor.map(generate_pdf_bytes, invoices, itertools.repeat(settings)):
+                yield pdf_data
+                done += 1
+        except BrokenProcessPool:
+            # Un proceso murió: descartar el pool y generar el resto en serie
+            get_pdf_executor.clear()
+    for inv in invoices[done:]:
+        yield generate_pdf_bytes(inv, settings)
 
 # --- 3. UI: SIDEBAR CONFIGURACIÓN ---
 
-with st.sidebar:
-    st.title("⚙️ Configuración")
-    
+# Fragmento: editar estos campos solo re-ejecuta el formulario, no la app entera.
+# Los cambios que afectan al área principal (aviso, logo del PDF) fuerzan un rerun completo.
+@st.fragment
+def company_settings_form():
+    notice = st.session_state.pop('_settings_notice', None)
     with st.expander("Datos de Mi Empresa", expanded=not st.session_state.settings['name']):
+        if notice:
+            st.success(notice)
+
         # Logo uploader
         uploaded_logo = st.file_uploader("Logo Empresa", type=['png', 'jpg', 'jpeg'])
-        if uploaded_logo:
-            # Save logo locally
+        # El uploader conserva el archivo entre reruns: procesarlo solo si es nuevo
+        if uploaded_logo and uploaded_logo.file_id != st.session_state.get('_logo_file_id'):
+            # Save logo locally, reducido y optimizado una sola vez (cada PDF lo decodifica)
+            from PIL import Image
             logo_path = os.path.join(FILES_DIR, "company_logo.png")
-            with open(logo_path, "wb") as f:
-                f.write(uploaded_logo.getbuffer())
+            img = Image.open(uploaded_logo)
+            img.thumbnail(LOGO_MAX_SIZE, Image.Resampling.LANCZOS)
+            if img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+                img = img.convert("RGBA") # p.ej. JPEG en CMYK
+            img.save(logo_path, format="PNG", optimize=True)
             st.session_state.settings['logo_path'] = logo_path
-            st.success("Logo actualizado")
+            st.session_state['_logo_file_id'] = uploaded_logo.file_id
+            st.session_state['_settings_notice'] = "Logo actualizado"
+            st.rerun()
 
         if st.session_state.settings['logo_path']:
             st.image(st.session_state.settings['logo_path'], width=100)
@@ -327,11 +629,17 @@ with st.sidebar:
                 "defaultTaxRate": new_tax
             })
             save_json(SETTINGS_FILE, st.session_state.settings)
-            st.success("Datos guardados correctamente.")
+            st.session_state['_settings_notice'] = "Datos guardados correctamente."
+            st.rerun()
+
+with st.sidebar:
+    st.title("⚙️ Configuración")
+    
+    company_settings_form()
 
     st.divider()
     st.markdown("### 🗂️ Base de Datos Clientes")
-    st.caption(f"{len(st.session_state.clients)} clientes guardados")
+    st.caption(f"{len(st.session_state.clients_by_name)} clientes guardados")
     # Podríamos añadir un gestor de clientes aquí si fuera necesario
 
 # --- 4. UI: ÁREA PRINCIPAL ---
@@ -342,11 +650,18 @@ st.markdown("Convierte tus **Albaranes** (PDF, Imagen) en **Facturas** automáti
 if not st.session_state.settings['name']:
     st.warning("☝️ Configura primero los datos de tu empresa en el menú lateral.")
 
+# Fallos de los guardados en segundo plano de esta sesión desde el último run
+for save_error in pop_save_errors():
+    st.error(f"⚠️ {save_error}. Vuelve a guardar para reintentarlo.")
+
 # TABS NAVIGATION
 tab_upload, tab_editor, tab_export = st.tabs(["1. Subir Albaranes", "2. Revisar & Editar", "3. Exportar"])
 
 # --- TAB 1: UPLOAD & PROCESS ---
-with tab_upload:
+# Fragmento: añadir o quitar archivos no re-ejecuta el editor ni la exportación.
+# Al terminar el procesamiento, st.rerun() recarga la app completa.
+@st.fragment
+def upload_tab():
     uploaded_files = st.file_uploader(
         "Arrastra tus albaranes aquí (Máx 10)", 
         type=['png', 'jpg', 'jpeg', 'pdf'], 
@@ -360,72 +675,122 @@ with tab_upload:
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            for i, file in enumerate(uploaded_files):
-                status_text.text(f"Procesando {file.name} con Gemini AI...")
-                
-                # Leer bytes
-                bytes_data = file.getvalue()
-                mime_type = file.type
+            gemini_client = get_gemini_client()
+            
+            # Leer bytes en el hilo principal (los hilos no tocan objetos de Streamlit)
+            jobs = [(file.getvalue(), file.type, file.name) for file in uploaded_files] if gemini_client else []
+            results = [None] * len(jobs)
+            
+            # Deduplicar por hash de contenido: un mismo albarán (en este lote o ya
+            # extraído antes) no vuelve a pasar por Gemini
+            pending = {}  # hash -> índices de los archivos con ese contenido
+            for i, (file_bytes, _, filename) in enumerate(jobs):
+                key = extraction_cache_key(file_bytes)
+                cached = get_cached_extraction(key)
+                if cached is not None:
+                    results[i] = {**copy.deepcopy(cached), 'filename': filename}
+                else:
+                    pending.setdefault(key, []).append(i)
+            done = len(jobs) - sum(len(idxs) for idxs in pending.values())
+            
+            # LLAMADAS A GEMINI en paralelo (I/O de red), con concurrencia acotada
+            if pending:
+                status_text.text(f"Procesando {len(pending)} archivos con Gemini AI...")
+                config, batch_config, prompt_parts = get_extraction_request()
                 
-                # LLAMADA A GEMINI
-                data = process_invoice_with_gemini(bytes_data, mime_type, file.name)
+                # Agrupar los albaranes pequeños en peticiones multi-documento, sin
+                # bajar de un grupo por hilo; los grandes (Files API) van de uno en uno
+                small = [key for key, idxs in pending.items() if len(jobs[idxs[0]][0]) <= INLINE_DATA_MAX_BYTES]
+                large = [key for key, idxs in pending.items() if len(jobs[idxs[0]][0]) > INLINE_DATA_MAX_BYTES]
+                group_size = max(1, min(BATCH_REQUEST_SIZE, math.ceil(len(small) / MAX_CONCURRENT_REQUESTS)))
+                groups = [small[j:j + group_size] for j in range(0, len(small), group_size)] + [[key] for key in large]
                 
+                with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(groups))) as executor:
+                    futures = {
+                        executor.submit(process_invoice_batch_with_gemini, gemini_client, [jobs[pending[key][0]] for key in group], config, batch_config, prompt_parts): group
+                        for group in groups
+                    }
+                    for future in as_completed(futures):
+                        for key, (data, error) in zip(futures[future], future.result()):
+                            if error:
+                                st.error(error)
+                            else:
+                                store_cached_extraction(key, data)
+                                # Guardar por índice para conservar el orden de subida
+                                for i in pending[key]:
+                                    results[i] = {**copy.deepcopy(data), 'filename': jobs[i][2]}
+                            done += len(pending[key])
+                        progress_bar.progress(done / len(jobs))
+            
+            # Datos del proveedor (Mi Empresa), comunes a todo el lote
+            settings = st.session_state.settings
+            supplier = {
+                "supplierName": settings['name'],
+                "supplierAddress": f"{settings['address']}\nCIF: {settings['cif']}",
+                "taxRate": settings['defaultTaxRate']
+            } if settings['name'] else None
+            
+            # Nombres de clientes en minúsculas, calculados una vez por lote
+            lowered_clients = [(c['name'].lower(), c) for c in st.session_state.clients_by_name.values()]
+            
+            for data in results:
                 if data:
                     # 1. Aplicar Configuración Empresa (Proveedor)
-                    if st.session_state.settings['name']:
-                        data['supplierName'] = st.session_state.settings['name']
-                        data['supplierAddress'] = f"{st.session_state.settings['address']}\nCIF: {st.session_state.settings['cif']}"
-                        data['taxRate'] = st.session_state.settings['defaultTaxRate']
+                    if supplier:
+                        data.update(supplier)
                         
                         # Recalcular totales con el nuevo IVA
-                        subtotal = sum(item['total'] for item in data['items'])
-                        tax_amount = round(subtotal * (data['taxRate'] / 100), 2)
-                        data['subtotal'] = subtotal
-                        data['taxAmount'] = tax_amount
-                        data['total'] = subtotal + tax_amount
+                        data.update(compute_totals(data['items'], data['taxRate']))
 
                     # 2. Buscar Cliente en BD (Autocompletado simple)
                     if data.get('clientName'):
-                        client_match = next((c for c in st.session_state.clients if c['name'].lower() in data['clientName'].lower() or data['clientName'].lower() in c['name'].lower()), None)
+                        needle = data['clientName'].lower()
+                        client_match = next((c for name, c in lowered_clients if name in needle or needle in name), None)
                         if client_match:
                             data['clientName'] = client_match['name']
                             data['clientCif'] = client_match['cif']
                             data['clientAddress'] = client_match['address']
                     
                     st.session_state.processed_invoices.append(data)
-                
-                progress_bar.progress((i + 1) / len(uploaded_files))
             
             status_text.success("¡Procesamiento completado!")
             st.session_state.current_invoice_index = 0
             st.rerun() # Recargar para ir a la siguiente pestaña o actualizar estado
 
+with tab_upload:
+    upload_tab()
+
 # --- TAB 2: EDITOR ---
 with tab_editor:
     if not st.session_state.processed_invoices:
         st.info("No hay facturas procesadas. Sube archivos en la pestaña 1.")
     else:
+        # Referencias locales: la factura actual es un dict mutable dentro de la
+        # lista, así que los cambios sobre current_inv ya quedan en session_state
+        invoices = st.session_state.processed_invoices
+        idx = st.session_state.current_invoice_index
+        current_inv = invoices[idx]
+        
         # Navegación entre facturas del lote
         col_nav_1, col_nav_2, col_nav_3 = st.columns([1, 4, 1])
         with col_nav_1:
-            if st.button("⬅️ Anterior") and st.session_state.current_invoice_index > 0:
-                st.session_state.current_invoice_index -= 1
+            if st.button("⬅️ Anterior") and idx > 0:
+                st.session_state.current_invoice_index = idx - 1
                 st.rerun()
         with col_nav_3:
-            if st.button("Siguiente ➡️") and st.session_state.current_invoice_index < len(st.session_state.processed_invoices) - 1:
-                st.session_state.current_invoice_index += 1
+            if st.button("Siguiente ➡️") and idx < len(invoices) - 1:
+                st.session_state.current_invoice_index = idx + 1
                 st.rerun()
         
         with col_nav_2:
-            st.markdown(f"<h3 style='text-align: center'>Factura {st.session_state.current_invoice_index + 1} de {len(st.session_state.processed_invoices)}</h3>", unsafe_allow_html=True)
-            st.caption(f"Archivo original: {st.session_state.processed_invoices[st.session_state.current_invoice_index].get('filename')}")
+            st.markdown(f"<h3 style='text-align: center'>Factura {idx + 1} de {len(invoices)}</h3>", unsafe_allow_html=True)
+            st.caption(f"Archivo original: {current_inv.get('filename')}")
 
         # EDITOR FORM
-        current_inv = st.session_state.processed_invoices[st.session_state.current_invoice_index]
         
         # Guardar cambios automáticamente al modificar inputs
         def update_field(key, new_value):
-            st.session_state.processed_invoices[st.session_state.current_invoice_index][key] = new_value
+            current_inv[key] = new_value
 
         c1, c2 = st.columns(2)
         with c1:
@@ -440,7 +805,7 @@ with tab_editor:
             st.subheader("Cliente")
             
             # Autocompletado de clientes
-            client_names = [c['name'] for c in st.session_state.clients]
+            client_names = list(st.session_state.clients_by_name)
             selected_client = st.selectbox(
                 "Seleccionar Cliente (Existente)", 
                 options=[""] + client_names, 
@@ -450,7 +815,7 @@ with tab_editor:
             
             # Si selecciona uno, rellenar datos
             if selected_client and selected_client != "":
-                client_obj = next(c for c in st.session_state.clients if c['name'] == selected_client)
+                client_obj = st.session_state.clients_by_name[selected_client]
                 current_inv['clientName'] = client_obj['name']
                 current_inv['clientCif'] = client_obj['cif']
                 current_inv['clientAddress'] = client_obj['address']
@@ -469,9 +834,10 @@ with tab_editor:
             if st.button("💾 Guardar Cliente en BD"):
                 new_client = {"name": c_name, "cif": c_cif, "address": c_addr}
                 # Actualizar o añadir
-                st.session_state.clients = [c for c in st.session_state.clients if c['name'] != c_name]
-                st.session_state.clients.append(new_client)
-                save_json(CLIENTS_FILE, st.session_state.clients)
+                clients_by_name = st.session_state.clients_by_name
+                clients_by_name.pop(c_name, None) # Se mueve al final, como antes
+                clients_by_name[c_name] = new_client
+                save_json(CLIENTS_FILE, list(clients_by_name.values()))
                 st.success(f"Cliente {c_name} guardado.")
 
         st.divider()
@@ -495,28 +861,24 @@ with tab_editor:
         )
         
         # Recalcular totales basado en la edición
-        new_subtotal = 0
-        for item in edited_items:
-            item['total'] = item['quantity'] * item['unitPrice']
-            new_subtotal += item['total']
+        compute_line_totals(edited_items)
             
         current_inv['items'] = edited_items
-        current_inv['subtotal'] = new_subtotal
         
         # Totales Finales
         col_t1, col_t2 = st.columns([3, 1])
         with col_t2:
             st.markdown("### Totales")
-            st.metric("Subtotal", f"{current_inv['subtotal']:.2f} €")
+            # Hueco para el subtotal, que se rellena tras leer el % IVA
+            subtotal_slot = st.empty()
             
             new_tax_rate = st.number_input("% IVA", value=float(current_inv.get('taxRate', 21)))
             current_inv['taxRate'] = new_tax_rate
+            current_inv.update(compute_totals(edited_items, new_tax_rate))
             
-            current_inv['taxAmount'] = current_inv['subtotal'] * (new_tax_rate / 100)
-            current_inv['total'] = current_inv['subtotal'] + current_inv['taxAmount']
-            
-            st.metric("IVA", f"{current_inv['taxAmount']:.2f} €")
-            st.metric("TOTAL", f"{current_inv['total']:.2f} €", delta_color="normal")
+            subtotal_slot.metric("Subtotal", format_eur(current_inv['subtotal']))
+            st.metric("IVA", format_eur(current_inv['taxAmount']))
+            st.metric("TOTAL", format_eur(current_inv['total']), delta_color="normal")
 
 # --- TAB 3: EXPORTAR ---
 with tab_export:
@@ -529,12 +891,17 @@ with tab_export:
         st.subheader("Vista Previa y Descarga Individual")
         current_inv_export = st.session_state.processed_invoices[st.session_state.current_invoice_index]
         
-        pdf_bytes = generate_pdf_bytes(current_inv_export, st.session_state.settings)
+        # Regenerar la vista previa solo si cambian la factura, los ajustes o el logo
+        preview_token = hashlib.blake2b(
+            orjson.dumps([current_inv_export, st.session_state.settings, get_logo_mtime(st.session_state.settings)], option=orjson.OPT_SORT_KEYS),
+            digest_size=8
+        ).digest()
+        if st.session_state.get('_preview_token') != preview_token:
+            st.session_state['_preview_pdf'] = render_invoice_pdf(current_inv_export, st.session_state.settings)
+            st.session_state['_preview_token'] = preview_token
         
-        # Mostrar PDF (truco para mostrar PDF embebido en Streamlit)
-        base64_pdf = base64.b64encode(pdf_bytes).decode('utf-8')
-        pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="500" type="application/pdf"></iframe>'
-        st.markdown(pdf_display, unsafe_allow_html=True)
+        pdf_bytes = st.session_state['_preview_pdf']
+        show_pdf_preview(pdf_bytes)
         
         st.download_button(
             label="⬇️ Descargar este PDF",
@@ -548,16 +915,20 @@ with tab_export:
         # Opción 2: Descargar ZIP Lote Completo
         st.subheader("Descarga por Lotes")
         if st.button("📦 Generar ZIP con Todas las Facturas"):
+            pdfs = generate_all_pdfs(st.session_state.processed_invoices, st.session_state.settings)
             zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w") as zf:
-                for inv in st.session_state.processed_invoices:
-                    pdf_data = generate_pdf_bytes(inv, st.session_state.settings)
+            # Sin DEFLATE: los streams de un PDF ya van comprimidos
+            with zipfile.ZipFile(zip_buffer, "w", compression=zipfile.ZIP_STORED) as zf:
+                for inv, pdf_data in zip(st.session_state.processed_invoices, pdfs):
                     filename = f"Factura_{inv.get('invoiceNumber', 'borrador')}.pdf"
                     zf.writestr(filename, pdf_data)
             
+            # Se entrega el BytesIO, no getvalue()/getbuffer(): Streamlit llama a
+            # getvalue(), que con el buffer ajustado devuelve el mismo objeto bytes
+            # sin copiarlo, así que el ZIP queda una sola vez en memoria
             st.download_button(
                 label="⬇️ Descargar ZIP Completo",
-                data=zip_buffer.getvalue(),
+                data=zip_buffer,
                 file_name=f"Facturas_Lote_{datetime.now().strftime('%Y%m%d')}.zip",
                 mime="application/zip",
                 type="primary"
@@ -0,0 +1,178 @@
+import functools
+import io
+import math
+import os
+
+# Generación de PDF de facturas. Vive en su propio módulo (sin Streamlit)
+# para poder ejecutarse en los procesos del pool de exportación.
+
+# Colores (RGB)
+PRIMARY = (37, 99, 235) # Blue-600
+DARK = (40, 40, 40)
+GRAY = (100, 100, 100)
+LIGHT_GRAY = (150, 150, 150)
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+CLIENT_BAR = (241, 245, 249)
+
+# Tabla de traducción creada una vez: 1,234.56 -> 1.234,56 (formato es-ES)
+_ES_NUMBER_TABLE = str.maketrans(",.", ".,")
+
+def _as_number(value):
+    # Celdas numéricas vacías del editor (None o NaN) se imprimen como 0
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 0
+    return value
+
+def format_eur(value):
+    return f"{value:,.2f}".translate(_ES_NUMBER_TABLE) + " €"
+
+@functools.lru_cache(maxsize=4)
+def _load_logo(path, mtime):
+    # Bytes del logo en memoria por proceso; la fecha invalida la entrada si cambia
+    with open(path, 'rb') as f:
+        return f.read()
+
+def generate_pdf_bytes(invoice_data, settings):
+    # Import diferido: fpdf solo se carga al exportar, no en cada arranque
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    pdf.add_page()
+    
+    # Cada bloque fija fuente y color una vez y dibuja todas las celdas que los
+    # comparten, para emitir menos operadores Tf/rg en el PDF
+    
+    # 1. Header & Logo
+    header_y = 20
+    
+    # Logo
+    if settings.get('logo_path') and os.path.exists(settings['logo_path']):
+        try:
+            logo_path = settings['logo_path']
+            logo_bytes = _load_logo(logo_path, os.path.getmtime(logo_path))
+            pdf.image(io.BytesIO(logo_bytes), x=10, y=10, w=30)
+            header_y = 45
+        except:
+            pass
+
+    # Proveedor (Arriba Izquierda o debajo de logo)
+    pdf.set_font("Helvetica", "B", 14)
+    pdf.set_text_color(*DARK)
+    pdf.set_xy(10 if not settings.get('logo_path') else 45, 15 if settings.get('logo_path') else 15)
+    
+    supplier_name = invoice_data.get('supplierName') or "PROVEEDOR"
+    pdf.cell(0, 10, supplier_name, new_x="LMARGIN", new_y="NEXT")
+    
+    pdf.set_font("Helvetica", "", 9)
+    pdf.set_text_color(*GRAY)
+    # Ajustar posición para dirección
+    pdf.set_xy(10 if not settings.get('logo_path') else 45, 22 if settings.get('logo_path') else 22)
+    pdf.multi_cell(80, 5, invoice_data.get('supplierAddress') or "")
+
+    # Título FACTURA (Arriba Derecha)
+    pdf.set_xy(150, 15)
+    pdf.set_font("Helvetica", "B", 20)
+    pdf.set_text_color(*PRIMARY)
+    pdf.cell(50, 10, "FACTURA", align='R')
+    
+    # Metadatos (Debajo de título): primero las etiquetas, luego los valores
+    pdf.set_font("Helvetica", "B", 9)
+    pdf.set_text_color(*GRAY)
+    pdf.set_xy(140, 25)
+    pdf.cell(30, 5, "Nº Factura:", align='R')
+    pdf.set_xy(140, 30)
+    pdf.cell(30, 5, "Fecha:", align='R')
+    
+    pdf.set_font("Helvetica", "", 9)
+    pdf.set_text_color(*BLACK)
+    pdf.set_xy(170, 25)
+    pdf.cell(30, 5, str(invoice_data.get('invoiceNumber', '---')), align='R')
+    pdf.set_xy(170, 30)
+    pdf.cell(30, 5, str(invoice_data.get('date', '')), align='R')
+
+    # 2. Cliente
+    start_y_client = max(pdf.get_y(), header_y) + 15
+    
+    pdf.set_xy(10, start_y_client)
+    pdf.set_fill_color(*CLIENT_BAR)
+    pdf.rect(10, start_y_client, 190, 8, 'F')
+    
+    pdf.set_xy(12, start_y_client + 1.5)
+    pdf.set_font("Helvetica", "B", 10)
+    pdf.set_text_color(*PRIMARY)
+    pdf.cell(0, 5, "FACTURAR A:")
+    
+    pdf.set_xy(10, start_y_client + 12)
+    pdf.set_text_color(*BLACK)
+    pdf.cell(0, 5, invoice_data.get('clientName') or "CLIENTE", new_x="LMARGIN", new_y="NEXT")
+    
+    pdf.set_font("Helvetica", "", 9)
+    pdf.set_text_color(*GRAY)
+    if invoice_data.get('clientCif'):
+        pdf.cell(0, 5, f"CIF/NIF: {invoice_data.get('clientCif')}", new_x="LMARGIN", new_y="NEXT")
+    pdf.multi_cell(0, 5, invoice_data.get('clientAddress') or "")
+
+    # 3. Tabla
+    pdf.set_y(pdf.get_y() + 10)
+    
+    # Cabecera Tabla
+    pdf.set_fill_color(*PRIMARY)
+    pdf.set_text_color(*WHITE)
+    pdf.set_font("Helvetica", "B", 9)
+    pdf.cell(95, 8, "Descripción", fill=True)
+    pdf.cell(20, 8, "Cant.", align='R', fill=True)
+    pdf.cell(35, 8, "Precio U.", align='R', fill=True)
+    pdf.cell(40, 8, "Total", align='R', fill=True, new_x="LMARGIN", new_y="NEXT")
+    
+    # Items
+    pdf.set_text_color(*BLACK)
+    pdf.set_font("Helvetica", "", 9)
+    fill = False
+    for item in invoice_data.get('items', []):
+        pdf.cell(95, 8, str(item.get('description') or ''), border='B')
+        pdf.cell(20, 8, str(_as_number(item.get('quantity'))), align='R', border='B')
+        pdf.cell(35, 8, format_eur(_as_number(item.get('unitPrice'))), align='R', border='B')
+        pdf.cell(40, 8, format_eur(_as_number(item.get('total'))), align='R', border='B', new_x="LMARGIN", new_y="NEXT")
+
+    # 4. Totales: etiquetas en gris, valores en negro y TOTAL en azul
+    y_totals = pdf.get_y() + 5
+    if y_totals + 22 > pdf.page_break_trigger:
+        # Las celdas se colocan con set_xy: sin esto, un salto de página
+        # automático a mitad de bloque descuadraría las filas. El bloque pasa
+        # entero a la página siguiente.
+        pdf.add_page()
+        y_totals = pdf.get_y()
+    x_totals = 130
+    tax_rate = invoice_data.get('taxRate', 21)
+    
+    pdf.set_text_color(*GRAY)
+    pdf.set_xy(x_totals, y_totals)
+    pdf.cell(30, 6, "Subtotal:", align='R')
+    pdf.set_xy(x_totals, y_totals + 6)
+    pdf.cell(30, 6, f"IVA ({tax_rate}%):", align='R')
+    
+    pdf.set_text_color(*BLACK)
+    pdf.set_xy(x_totals + 30, y_totals)
+    pdf.cell(30, 6, format_eur(invoice_data.get('subtotal', 0)), align='R')
+    pdf.set_xy(x_totals + 30, y_totals + 6)
+    pdf.cell(30, 6, format_eur(invoice_data.get('taxAmount', 0)), align='R')
+    
+    pdf.set_xy(x_totals, y_totals + 12)
+    pdf.set_font("Helvetica", "B", 11)
+    pdf.set_text_color(*PRIMARY)
+    pdf.cell(30, 10, "TOTAL:", align='R')
+    pdf.cell(30, 10, format_eur(invoice_data.get('total', 0)), align='R')
+
+    # 5. Notas
+    if invoice_data.get('notes'):
+        pdf.set_y(pdf.get_y() + 15)
+        pdf.set_font("Helvetica", "B", 8)
+        pdf.set_text_color(*LIGHT_GRAY)
+        pdf.cell(0, 5, "NOTAS:", new_x="LMARGIN", new_y="NEXT")
+        pdf.set_font("Helvetica", "", 8)
+        pdf.multi_cell(0, 5, invoice_data.get('notes'))
+
+    # bytearray tal cual, sin copia: zipfile y pickle lo aceptan. Quien necesite
+    # bytes estrictos (widgets de Streamlit) convierte en su propia frontera.
+    return pdf.output()